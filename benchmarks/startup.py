@@ -0,0 +1,125 @@
+"""Benchmark: cold start of a short-lived bot
+
+Measures constructing a WikiCache and reading a few pages that are already
+in the cache (but not known to be current), when the cache needs a sync
+with the server (the last sync was long ago and many pages of recent changes
+are waiting).
+The server is simulated; every API request takes `--latency` seconds.
+
+Run as: python benchmarks/startup.py
+"""
+
+import io
+import os
+import sys
+import time
+import argparse
+import datetime
+import tempfile
+
+import gevent
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from gwikibot.wikicache import WikiCache
+
+TITLES = ['Page %s' % i for i in range(3)]
+
+
+class SimulatedWikiCache(WikiCache):
+    """WikiCache talking to a simulated, slow MediaWiki server"""
+    latency = 0.05
+    changes_pages = 10
+
+    def apirequest(self, **params):
+        gevent.sleep(self.latency)
+        self._request_done()
+        if params.get('list') == 'recentchanges':
+            page = int(params.get('rccontinue', 0))
+            feed = {'query': {'recentchanges': [
+                {'timestamp': '2000-01-01T00:00:00Z',
+                 'title': 'Other page %s' % page, 'user': 'Someone'}]}}
+            if page + 1 < self.changes_pages:
+                feed['query-continue'] = {
+                    'recentchanges': {'rccontinue': str(page + 1)}}
+            return feed
+        pages = [dict(title=title, revisions=[dict(revid=1)])
+                 for title in params['titles'].split('|')]
+        return {'query': {'pages': pages}}
+
+    def _apirequest_raw(self, **params):
+        gevent.sleep(self.latency)
+        self._request_done()
+        pages = ''.join(
+            '<page><title>{0}</title><revision><id>1</id>'
+            '<text>Text of {0}</text></revision></page>'.format(title)
+            for title in params['titles'].split('|'))
+        response = lambda: None
+        response.raw = io.BytesIO(
+            '<mediawiki xmlns="x">{}</mediawiki>'.format(pages).encode())
+        return response
+
+
+def make_cache(db_url, **kwargs):
+    return SimulatedWikiCache('http://wiki.invalid/api.php', db_url=db_url,
+        limit=0, **kwargs)
+
+
+def stop(cache):
+    """Stop the cache's request loop"""
+    if cache._loop is not None:
+        cache._loop.kill()
+
+
+def prepare_db(db_url):
+    """Fill the cache with TITLES, invalidate it and make its last sync old"""
+    cache = make_cache(db_url)
+    for title in TITLES:
+        cache[title].text
+    stop(cache)
+    wiki = cache.get_wiki()
+    cache.invalidate_cache(wiki)
+    wiki.last_update = datetime.datetime.today() - datetime.timedelta(days=1)
+    wiki.session.commit()
+
+
+def run(db_url, **kwargs):
+    start = time.time()
+    cache = make_cache(db_url, **kwargs)
+    constructed = time.time()
+    pages = [cache[title] for title in TITLES]
+    for page in pages:
+        page.text
+    done = time.time()
+    stop(cache)
+    return constructed - start, done - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency', type=float,
+        default=SimulatedWikiCache.latency)
+    parser.add_argument('--changes-pages', type=int,
+        default=SimulatedWikiCache.changes_pages)
+    args = parser.parse_args()
+    SimulatedWikiCache.latency = args.latency
+    SimulatedWikiCache.changes_pages = args.changes_pages
+
+    print('{} pages of changes, {}s per API request'.format(
+        args.changes_pages, args.latency))
+    for name, kwargs in [
+            ('default', {}),
+            ('read_stale_ok', dict(read_stale_ok=True))]:
+        db_file = tempfile.NamedTemporaryFile(suffix='.sqlite', delete=False)
+        db_file.close()
+        try:
+            prepare_db(db_file.name)
+            construct, read = run(db_file.name, **kwargs)
+        finally:
+            os.unlink(db_file.name)
+        print('{:15} construct: {:.4f}s   read {} pages: {:.4f}s'.format(
+            name, construct, len(TITLES), read))
+
+
+if __name__ == '__main__':
+    main()
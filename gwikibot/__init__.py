@@ -1 +1,8 @@
-from gwikibot.wikicache import WikiCache
+def __getattr__(name):
+    # WikiCache is imported lazily, so that users of the asyncio cache
+    # don't need gevent
+    if name == 'WikiCache':
+        from gwikibot.wikicache import WikiCache
+        return WikiCache
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))
@@ -0,0 +1,277 @@
+"""An asyncio-based MediaWiki cache
+
+This is the asyncio counterpart of :mod:`gwikibot.wikicache`. It batches
+requests the same way, but does not need gevent or any monkey-patching.
+HTTP requests are made with aiohttp.
+"""
+
+import io
+import asyncio
+
+import aiohttp
+import yaml
+
+from gwikibot.cachebase import BaseWikiCache, BasePageProxy, Request
+
+
+class AsyncPageProxy(BasePageProxy):
+    """A page in a wiki
+
+    The page may not be loaded when this object is created. Await the proxy
+    to load it; the awaited value is the proxy itself::
+
+        page = await cache['Some page']
+        print(page.text)
+
+    Accessing the page's attributes before it is loaded raises RuntimeError.
+
+    A page is true in a boolean context if it exists on the wiki.
+    """
+    def _wait(self):
+        if not self._result.done():
+            raise RuntimeError(
+                'Page {} is not loaded yet; await it first'.format(self.title))
+        self._result.result()
+
+    def __await__(self):
+        return self._load().__await__()
+
+    async def _load(self):
+        await self._result
+        return self
+
+    async def edit(self, text, section=None):
+        await self
+        await self._queue_edit(text, section).go()
+
+
+class AsyncWikiCache(BaseWikiCache):
+    """An asyncio-based cache of a MediaWiki
+
+    See :class:`gwikibot.cachebase.BaseWikiCache` for the other parameters.
+
+    :param force_sync: If true, the first sync with the server is done even
+        if the last one was less than five minutes ago.
+
+    ``cache[page_title]`` gives an AsyncPageProxy object, which must be
+    awaited before use. Pages can only be requested while the event loop
+    is running.
+
+    Call :meth:`close` (or use the cache as an async context manager) to stop
+    the request loop and release the HTTP session.
+    """
+    page_proxy_class = AsyncPageProxy
+
+    def __init__(
+            self, url_base, db_url=None, force_sync=False, limit=5,
+            verbose=False, read_stale_ok=False):
+        super(AsyncWikiCache, self).__init__(
+            url_base, db_url=db_url, limit=limit, verbose=verbose,
+            read_stale_ok=read_stale_ok)
+
+        self.request_queue = asyncio.Queue()
+
+        self._updated = asyncio.Event()
+        self._force_sync = force_sync
+        self._loop = None
+        self._loop_error = None
+        self._tasks = set()
+        self._http = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Stop the request loop and close the HTTP session
+
+        Pages and requests that are still being waited for are cancelled.
+        """
+        tasks = list(self._tasks)
+        if self._loop is not None:
+            tasks.append(self._loop)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        pending, self._pending = self._pending, set()
+        for request in pending:
+            request.result.cancel()
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def _new_result(self):
+        return asyncio.get_running_loop().create_future()
+
+    def _set_result(self, result, value):
+        if not result.done():
+            result.set_result(value)
+
+    def _set_exception(self, result, exc):
+        if not result.done():
+            result.set_exception(exc)
+
+    def _spawn(self, coro):
+        """Run a coroutine in a task that close() will cancel"""
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _go(self, request):
+        await self.request(request)
+        return await request.result
+
+    async def _drive(self, steps):
+        value = None
+        while True:
+            try:
+                call = steps.send(value)
+            except StopIteration:
+                return
+            value = await self._perform(call)
+
+    async def _perform(self, call):
+        """Perform an APICall or Request yielded by a step generator"""
+        if isinstance(call, Request):
+            return await call.go()
+        elif call.raw:
+            return io.BytesIO(await self._apirequest_raw(**call.params))
+        else:
+            return await self.apirequest(**call.params)
+
+    async def request(self, req):
+        if self._loop is None or self._loop.done():
+            if self._loop is None:
+                force_sync = self._force_sync
+            else:
+                self.log('Restarting request loop')
+                force_sync = False
+            self._loop_error = None
+            self._updated.clear()
+            self._loop = asyncio.ensure_future(self._request_loop(force_sync))
+            if not self.read_stale_ok:
+                await self._updated.wait()
+                if self._loop_error is not None:
+                    raise self._loop_error
+        if req:
+            self._pending.add(req)
+            self.request_queue.put_nowait(req)
+
+    async def _sleep_before_request(self):
+        """Sleep before another request can be made
+
+        The request rate is controlled by the "limit" attribute
+        """
+        sleep_seconds = self._sleep_seconds()
+        if sleep_seconds > 0:
+            self.log('Sleeping %ss' % sleep_seconds)
+            await asyncio.sleep(sleep_seconds)
+
+    async def _apirequest_raw(self, **params):
+        """Raw MW API request; returns the response body as bytes"""
+
+        await self._sleep_before_request()
+
+        if self._http is None:
+            self._http = aiohttp.ClientSession()
+
+        try:
+            self.log('POST {} {}'.format(self._url_base, params))
+            # Form values are stringified the same way `requests` does it
+            data = {k: str(v) for k, v in params.items()}
+            async with self._http.post(self._url_base, data=data) as result:
+                result.raise_for_status()
+                return await result.read()
+        finally:
+            self._request_done()
+
+    async def apirequest(self, **params):
+        """MW API request; returns result dict"""
+        params['format'] = 'yaml'
+        return yaml.safe_load(await self._apirequest_raw(**params))
+
+    async def update(self, force_sync=False):
+        """Fetch a batch of page changes from the server"""
+        await self._drive(self._update_steps(force_sync=force_sync))
+
+    async def _get_request(self, timeout):
+        """Get a request from the queue, or None after `timeout` seconds"""
+        try:
+            return await asyncio.wait_for(self.request_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _request_loop(self, force_sync=False):
+        """The task that requests needed metadata/pages
+
+        If it fails, the error is passed on to all waiting requests.
+        """
+        try:
+            await self._process_requests(force_sync)
+        except Exception as e:
+            self.log('Request loop failed: {!r}'.format(e))
+            while not self.request_queue.empty():
+                self.request_queue.get_nowait()
+            self._loop_error = e
+            self._fail_pending(e)
+            self._updated.set()
+
+    async def _process_requests(self, force_sync):
+        """Sync the cache, then batch and run requests until there are none
+        """
+        await self.update(force_sync=force_sync)
+        self._updated.set()
+
+        requests = {}
+        while True:
+            self.log('Request loop active')
+            await self.update()
+
+            while True:
+                while not self.request_queue.empty():
+                    request = self.request_queue.get_nowait()
+                    if request.insert_into(requests):
+                        await request.run(requests)
+                    await asyncio.sleep(0)
+                request = await self._get_request(self._sleep_seconds())
+                if request is None:
+                    break
+                elif request.insert_into(requests):
+                    await request.run(requests)
+
+            request_list = [(k, v) for k, v in requests.items() if v]
+            request_list.sort(key=lambda k_v: -len(k_v[1]))
+            requests = dict(request_list)
+            if request_list:
+                for k, v in request_list[0][1].items():
+                    await v.run(requests)
+                    break
+
+            if not request_list:
+                await self._sleep_before_request()
+                if self.request_queue.empty():
+                    self._updated.clear()
+                    self.log('Request loop exiting')
+                    return
+
+    def _start_read(self, result, token_requests):
+        self._spawn(self._read(result, token_requests))
+
+    async def _read(self, result, token_requests=()):
+        """Task to fill an AsyncPageProxy object
+
+        Submits work to the queues until a page is fully fetched from the
+        server, then sets the proxy's result to unblock the consumer.
+        If that fails, the error is passed on to the consumer.
+        """
+        try:
+            await self.request(None)
+            await self._drive(self._read_steps(result, token_requests))
+        except asyncio.CancelledError:
+            result._result.cancel()
+            raise
+        except Exception as e:
+            self._set_exception(result._result, e)
@@ -0,0 +1,636 @@
+"""Backend-neutral parts of the wiki cache
+
+The logic of talking to the wiki and keeping the database in sync lives here,
+written as generators of "steps" that yield the API calls and requests they
+need and get their results sent back in. The concrete caches
+(gevent-based :class:`gwikibot.wikicache.WikiCache` and asyncio-based
+:class:`gwikibot.aiowikicache.AsyncWikiCache`) drive these generators with
+their own concurrency primitives.
+"""
+
+import os
+import datetime
+import itertools
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import sqlalchemy.orm.exc
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from gwikibot import cacheschema
+
+
+class APICall(object):
+    """A MW API call yielded from a step generator
+
+    The result dict is sent back into the generator.
+    """
+    raw = False
+
+    def __init__(self, **params):
+        self.params = params
+
+
+class RawAPICall(APICall):
+    """A MW API call whose result is sent back as a file-like object"""
+    raw = True
+
+
+class BasePageProxy(object):
+    """A page in a wiki
+
+    The page may not be loaded when this object is created.
+    Subclasses define _wait, which makes sure the page is loaded.
+
+    A page is true in a boolean context if it exists on the wiki.
+    """
+    def __init__(self, cache, title):
+        self.title = title
+        self.cache = cache
+        self._result = cache._new_result()
+        self.edits = {}
+
+    def _set_result(self, contents, page_info):
+        self._contents = contents
+        self.page_info = page_info
+        self.cache._set_result(self._result, None)
+
+    def _wait(self):
+        raise NotImplementedError()
+
+    @property
+    def contents(self):
+        """Return the contents of the page, or None if it doesn't exist"""
+        self._wait()
+        return self._contents
+
+    @property
+    def exists(self):
+        """Return true if the page exists on the wiki"""
+        return self.contents is not None
+
+    @property
+    def text(self):
+        """Return the contents of the page; raise ValueError if page missing"""
+        self._wait()
+        if self.exists:
+            return self.contents
+        else:
+            raise ValueError('Page does not exist')
+
+    def __bool__(self):
+        return self.exists
+    __nonzero__ = __bool__
+
+    def _queue_edit(self, text, section):
+        """Record an edit and return the EditRequest that will make it"""
+        self._wait()
+        if not self.page_info['edittoken']:
+            raise ValueError('This Page is not editable')
+        else:
+            self.edits[section] = text
+            return EditRequest(self.cache, self)
+
+
+class BaseWikiCache(object):
+    """A cache of a MediaWiki
+
+    :param url_base: Base URL of the MediaWiki API,
+        e.g. 'http://en.wikipedia.org/w/api.php'
+    :param db_url: Path to a SQLite file holding the cache, or SQLAlchemy
+        database URL. If not given, a file next to the wikicache module will be
+        used.
+    :param limit: The cache will not make more than one request each `limit`
+        seconds.
+    :param read_stale_ok: If true, pages that are in the cache are served
+        right away, even if they might have changed on the server since
+        the last sync. The sync runs in the background.
+
+    Use the cache as a dictionary: ``cache[page_title]`` will give you a
+    page proxy object.
+
+    Nothing is done on construction: the database is opened on first use,
+    and the server is only contacted when a page is requested.
+
+    Subclasses provide the concurrency primitives: _new_result, _set_result,
+    _set_exception, _start_read, _go and _drive, and the page proxy class.
+    """
+    page_proxy_class = None
+
+    def __init__(self, url_base, db_url=None, limit=5, verbose=False,
+            read_stale_ok=False):
+        self.verbose = verbose
+
+        if db_url is None:
+            db_url = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                'wikicache.sqlite')
+        self.db_url = db_url
+
+        if '://' not in db_url:
+            db_url = os.path.abspath(db_url)
+            db_url = 'sqlite:///' + db_url
+
+        self._sqla_url = db_url
+        self._engine = None
+        self._sessionmaker = None
+
+        self._url_base = url_base
+        self.limit = limit
+        self.read_stale_ok = read_stale_ok
+
+        # Requests submitted to the request loop and not finished yet
+        self._pending = set()
+
+    def _new_result(self):
+        """Return a new object that will hold a result of a request"""
+        raise NotImplementedError()
+
+    def _set_result(self, result, value):
+        """Set the value of a result created by _new_result"""
+        raise NotImplementedError()
+
+    def _set_exception(self, result, exc):
+        """Make a result created by _new_result raise an exception"""
+        raise NotImplementedError()
+
+    def _fail_pending(self, exc):
+        """Pass an error from the request loop on to all waiting requests"""
+        pending, self._pending = self._pending, set()
+        for request in pending:
+            self._set_exception(request.result, exc)
+
+    def _start_read(self, result, token_requests):
+        """Start filling a page proxy in the background"""
+        raise NotImplementedError()
+
+    def _go(self, request):
+        """Schedule a Request and wait for its result"""
+        raise NotImplementedError()
+
+    def _drive(self, steps):
+        """Run a step generator, performing the calls it yields"""
+        raise NotImplementedError()
+
+    def _make_session(self):
+        """Return a new DB session
+
+        The database is connected to, and its schema created if necessary,
+        on the first call.
+        """
+        if self._sessionmaker is None:
+            engine = create_engine(self._sqla_url)
+            cacheschema.metadata.create_all(engine)
+            self._engine = engine
+            self._sessionmaker = sessionmaker(bind=engine)
+        return self._sessionmaker()
+
+    def get_wiki(self):
+        """Get the wiki object, creating one if necessary"""
+        session = self._make_session()
+        query = session.query(cacheschema.Wiki).filter_by(
+            url_base=self._url_base)
+        try:
+            wiki = query.one()
+        except sqlalchemy.orm.exc.NoResultFound:
+            wiki = cacheschema.Wiki()
+            wiki.url_base = self._url_base
+            wiki.sync_timestamp = None
+            session.add(wiki)
+            session.commit()
+        wiki.session = session
+        return wiki
+
+    def log(self, string):
+        """Log a message"""
+        # TODO: Something more fancy
+        if self.verbose:
+            print(string)
+
+    def _sleep_seconds(self):
+        """Number of seconds to sleep until next request"""
+        now = lambda: datetime.datetime.today()
+        try:
+            next_time = self._next_request_time
+        except AttributeError:
+            return 0
+        else:
+            sleep_seconds = (next_time - now()).total_seconds()
+            if sleep_seconds > 0:
+                return sleep_seconds
+            else:
+                return 0
+
+    def _request_done(self):
+        """Note that a request was made, for rate limiting"""
+        self._next_request_time = (datetime.datetime.today() +
+                datetime.timedelta(seconds=self.limit))
+
+    def _update_steps(self, force_sync=False):
+        """Steps to fetch a batch of page changes from the server"""
+        wiki = self.get_wiki()
+        if wiki.last_update and not force_sync:
+            thresh = datetime.datetime.today() - datetime.timedelta(minutes=5)
+            if wiki.last_update > thresh:
+                self.log('Skipping update (last update was {})'.format(
+                    wiki.last_update))
+                return
+        if wiki.sync_timestamp is None:
+            self.log('Initial cache setup')
+            feed = yield APICall(action='query', list='recentchanges',
+                    rcprop='timestamp', rclimit=1)
+            last_change = feed['query']['recentchanges'][0]
+            wiki.sync_timestamp = last_change['timestamp']
+            wiki.synced = True
+            self.invalidate_cache(wiki)
+            wiki.session.commit()
+        else:
+            self.log('Updating cache')
+            feed = yield APICall(action='query', list='recentchanges',
+                    rcprop='title|user|timestamp', rclimit=100,
+                    rcend=wiki.sync_timestamp
+                )
+            sync_timestamp = feed['query']['recentchanges'][0]['timestamp']
+            while feed:
+                invalidated = set()
+                changes = feed['query']['recentchanges']
+                for change in changes:
+                    title = change['title']
+                    if title not in invalidated:
+                        self.log(u'Change to {0} by {1}'.format(title,
+                                change['user']))
+                        obj = self._page_object(wiki, title)
+                        obj.last_revision = None
+                        invalidated.add(title)
+                wiki.session.commit()
+                try:
+                    continue_params = feed['query-continue']['recentchanges']
+                except KeyError:
+                    feed = None
+                    wiki.sync_timestamp = sync_timestamp
+                    wiki.synced = True
+                else:
+                    feed = yield APICall(action='query', list='recentchanges',
+                            rcprop='title|user|timestamp', rclimit=100,
+                            rcend=wiki.sync_timestamp,
+                            **continue_params
+                        )
+                    wiki.synced = False
+                wiki.session.commit()
+        wiki.last_update = datetime.datetime.today()
+        wiki.session.commit()
+
+    def _page_query(self, wiki):
+        """Return a SQLA query for pages on this wiki"""
+        return wiki.session.query(cacheschema.Page).filter_by(wiki=wiki)
+
+    def _page_object(self, wiki, title):
+        """Get an object for the page 'title', *w/o* adding it to the session
+        """
+        title = self.normalize_title(title)
+        obj = wiki.session.query(cacheschema.Page).get((self._url_base, title))
+        if obj:
+            return obj
+        else:
+            obj = cacheschema.Page()
+            obj.wiki = wiki
+            obj.title = title
+            obj.revision = None
+            obj.last_revision = None
+            return obj
+
+    def invalidate_cache(self, wiki):
+        """Invalidate the entire cache
+
+        This marks all articles for re-downloading when requested.
+        Note that articles with a current revision ID will not be re-downloaded
+        entirely, only their metadata will be queried.
+        (To clear the cache entirely, truncate the articles table.)
+        """
+        self._page_query(wiki).update({'last_revision': None})
+        wiki.session.commit()
+
+    def normalize_title(self, title):
+        # TODO: http://www.mediawiki.org/wiki/API:Query#Title_normalization
+        title = title.replace('_', ' ')
+        title = title.replace('\n', '')
+        return title[0].upper() + title[1:]
+
+    def get(self, title, follow_redirect=False):
+        """Return a page from this cache
+
+        :param follow_redirect: If True, a Mediawiki redirect will be followed
+            once.
+        """
+        title = self.normalize_title(title)
+
+        if follow_redirect:
+            try:
+                return self[self.redirect_target(title)]
+            except KeyError:
+                pass
+
+        if not title:
+            return default
+
+        result = self.page_proxy_class(self, title)
+
+        self._start_read(result, ())
+        return result
+
+    def _read_steps(self, result, token_requests=()):
+        """Steps to fill a page proxy object
+
+        Submits requests until a page is fully fetched from the
+        server, then sets the page proxy result to unblock the consumer
+        """
+        wiki = self.get_wiki()
+        title = result.title
+        obj = self._page_object(wiki, title)
+        wiki.session.add(obj)
+        wiki.session.commit()
+        # Serve what we have without waiting for the sync, if that's allowed
+        if (self.read_stale_ok and not token_requests and
+                obj.revision is not None):
+            self.log('Serving cached {}'.format(title))
+            result._set_result(obj.contents, {})
+            wiki.session.rollback()
+            return
+        # Make sure we know the page's last revision
+        # This is a loop with rollbacks in it, since the DB can change under us
+        while True:
+            # Fetch metadata to see if the page has changed (or is empty!)
+            if obj.last_revision is None or (not obj.up_to_date and
+                    obj.contents is None) or token_requests:
+                self.log('Requesting metadata for {}'.format(title))
+                page_info = yield MetadataRequest(self, title, token_requests)
+            else:
+                page_info = {}
+            # Now, if metadata says we're out of date, actually fetch the page
+            wiki.session.refresh(obj)
+            if not obj.up_to_date:
+                self.log('Requesting page {}'.format(title))
+                yield PageRequest(self, title)
+            # If everything was successful, notify the caller!
+            wiki.session.refresh(obj)
+            if obj.up_to_date:
+                result._set_result(obj.contents, page_info)
+                wiki.session.rollback()
+                return
+
+    def __getitem__(self, title):
+        """Return the content of a page, if it exists, or raise KeyError
+        """
+        return self.get(title)
+
+    def get_editable(self, title):
+        title = self.normalize_title(title)
+        result = self.page_proxy_class(self, title)
+        self._start_read(result, ['edit'])
+        return result
+
+
+class Request(object):
+    """A request to the remote server
+
+    Requests can be grouped together by a "group key". All requests with
+    the same group key can be gotten with the same API request.
+
+    The cache's request-loop will take requests, and as soon as there's enough
+    of them for an an API request, it does that request.
+    If there's not enough requests for a while, it fires an "incomplete"
+    request.
+    """
+    limit = 50
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.result = cache._new_result()
+        self._subordinates = []
+
+    def go(self):
+        """Schedule the request and wait until it's done"""
+        return self.cache._go(self)
+
+    def run(self, all_requests):
+        """Perform this request (and its peers in all_requests)"""
+        return self.cache._drive(self.steps(all_requests))
+
+    def insert_into(self, all_requests):
+        """Insert this request into the given dict
+
+        Return true if enough requests have accumulated for an API request;
+        the request-loop should then run this request.
+        How many are needed is specified in the "limit" variable.
+        """
+        peers = all_requests.setdefault(self.group_key, {})
+        try:
+            master = peers[self.key]
+        except KeyError:
+            peers[self.key] = self
+        else:
+            master._subordinates.append(self)
+        return len(peers) >= self.limit
+
+    @property
+    def group_key(self):
+        return (self, )
+
+    @property
+    def key(self):
+        return self
+
+    def steps(self, all_requests):
+        """Steps to perform this request (and its peers in all_requests)"""
+        return iter(())
+
+    def _finish(self, value=None):
+        """Set the result of this request"""
+        self.cache._pending.discard(self)
+        self.cache._set_result(self.result, value)
+
+    def _all_finished_requests(self, all_requests, key):
+        master = all_requests.get(self.group_key, {}).pop(key, None)
+        if master:
+            yield master
+            for s in master._subordinates:
+                yield s
+
+
+def powerset(iterable):
+    "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
+    s = list(iterable)
+    return itertools.chain.from_iterable(
+        itertools.combinations(s, r) for r in range(len(s)+1))
+
+
+class MetadataRequest(Request):
+    limit = 100
+
+    def __init__(self, cache, title, token_requests):
+        super(MetadataRequest, self).__init__(cache)
+        self.title = title
+        self.token_requests = tuple(sorted(token_requests))
+
+    @property
+    def group_key(self):
+        return MetadataRequest, self.token_requests
+
+    @property
+    def key(self):
+        return self.title
+
+    def _all_finished_requests(self, all_requests, key):
+        # A bit more complicated since we can mark all requests with a subset
+        # of our tokens as done
+        mdr, token_requests = self.group_key
+        for subset in powerset(token_requests):
+            peers = all_requests.get((MetadataRequest, subset), {})
+            master = peers.pop(key, None)
+            if master:
+                yield master
+                for s in master._subordinates:
+                    yield s
+
+    def steps(self, all_requests):
+        wiki = self.cache.get_wiki()
+        titles = list(all_requests[self.group_key].keys())
+        # TODO: Fill up request if we can fetch more
+        kwargs = dict(
+                action='query', info='lastrevid',
+                prop='revisions',  # should not be necessary on modern MW
+                titles='|'.join(titles)
+            )
+        if self.token_requests:
+            kwargs['prop'] += '|info'
+            kwargs['intoken'] = '|'.join(self.token_requests)
+        result = yield APICall(**kwargs)
+        assert 'normalized' not in result['query'], (
+                result['query']['normalized'])  # XXX: normalization
+        for page_info in result['query'].get('pages', []):
+            title = page_info['title']
+            page = self.cache._page_object(wiki, title)
+            wiki.session.add(page)
+            if 'missing' in page_info:
+                page.last_revision = 0
+                page.revision = 0
+                page.contents = None
+            else:
+                revid = page_info['revisions'][0]['revid']
+                # revid = page_info['lastrevid']  # for the modern MW
+                page.last_revision = revid
+            for p in self._all_finished_requests(all_requests, title):
+                p._finish(page_info)
+        wiki.session.commit()
+
+
+class PageRequest(Request):
+    def __init__(self, cache, title):
+        super(PageRequest, self).__init__(cache)
+        self.title = title
+
+    @property
+    def group_key(self):
+        return (PageRequest,)
+
+    @property
+    def key(self):
+        return self.title
+
+    def steps(self, all_requests):
+        wiki = self.cache.get_wiki()
+        titles = list(all_requests[self.group_key].keys())
+
+        dump = yield RawAPICall(action='query',
+            export='1', exportnowrap='1',
+            titles='|'.join(titles))
+        tree = ElementTree.parse(dump)
+        for elem in tree.getroot():
+            tag = elem.tag
+            if tag.endswith('}siteinfo'):
+                continue
+            elif tag.endswith('}page'):
+                revision, = (e for e in elem if e.tag.endswith('}revision'))
+                pagename, = (e for e in elem if e.tag.endswith('}title'))
+                text, = (e for e in revision if e.tag.endswith('}text'))
+                revid, = (e for e in revision if e.tag.endswith('}id'))
+                title = pagename.text
+                page = self.cache._page_object(wiki, title)
+                page.last_revision = int(revid.text)
+                page.revision = int(revid.text)
+                page.contents = text.text
+                wiki.session.add(page)
+                for p in self._all_finished_requests(all_requests, title):
+                    p._finish()
+            else:
+                raise ValueError(tag)
+        wiki.session.commit()
+
+
+class SingleRequest(Request):
+    """A request that can't be combined with others
+
+    A SingleRequest is run as soon as it's picked up from the request queue.
+    """
+    limit = 1
+
+    def insert_into(self, all_requests):
+        return True
+
+
+class EditRequest(SingleRequest):
+    def __init__(self, cache, pageproxy):
+        super(EditRequest, self).__init__(cache)
+        self.pageproxy = pageproxy
+        self.title = pageproxy.title
+        self.edittoken = pageproxy.page_info['edittoken']
+        self.starttimestamp = pageproxy.page_info['starttimestamp']
+
+    def steps(self, all_requests):
+        pageproxy = self.pageproxy
+        edits = pageproxy.edits
+        if not edits:
+            # An earlier EditRequest for this page already made our edits
+            self._finish()
+            return
+
+        wiki = self.cache.get_wiki()
+        page = self.cache._page_object(wiki, self.title)
+        # Forget the old contents, so they are not served as stale reads
+        page.last_revision = None
+        page.revision = None
+        page.contents = None
+        wiki.session.commit()
+
+        whole_page_edit = edits.pop(None, None)
+        if (whole_page_edit is not None and
+                (pageproxy.contents is None or
+                    whole_page_edit != pageproxy.contents)):
+            result = yield self.edit_call(None, whole_page_edit)
+            self.starttimestamp = result['edit']['newtimestamp']
+        while edits:
+            section, text = edits.popitem()
+            result = yield self.edit_call(section, text)
+            self.starttimestamp = result['edit']['newtimestamp']
+
+        self._finish()
+
+    def edit_call(self, section, text):
+        """Return the APICall that edits the given section"""
+        kwargs = dict(
+            action='edit',
+            title=self.title,
+            text=text,
+            token=self.edittoken,
+            summary='gwikibot edit',  # TODO
+            minor=False,  # TODO
+            bot=True,  # TODO
+            starttimestamp=self.starttimestamp,
+            # TODO: recreate, createonly, nocreate
+        )
+        if section is not None:
+            kwargs['section'] = section
+        return APICall(**kwargs)
@@ -1,4 +1,9 @@
 import gevent.monkey
 
 def patch():
+    """Patch the socket module so gevent can switch greenlets during HTTP requests
+
+    This is not done on import; call it before using
+    :class:`gwikibot.wikicache.WikiCache`.
+    """
     gevent.monkey.patch_socket()
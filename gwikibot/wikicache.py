@@ -1,30 +1,15 @@
-import os
-import datetime
-import heapq
-import itertools
-import collections
-
 import gevent
 import requests
 from gevent.event import AsyncResult, Event
 from gevent.queue import Queue, Empty
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-import sqlalchemy.exc
-import yaml
-
-try:
-    import xml.etree.cElementTree as ElementTree
-except ImportError:
-    import xml.etree.ElementTree as ElementTree
 
-from gwikibot import cacheschema
-from gwikibot import monkey
+import yaml
 
-monkey.patch()
+from gwikibot.cachebase import (BaseWikiCache, BasePageProxy, Request,
+    MetadataRequest, PageRequest, SingleRequest, EditRequest, powerset)
 
 
-class PageProxy(object):
+class PageProxy(BasePageProxy):
     """A page in a wiki
 
     The page may not be loaded when this object is created; accessing its
@@ -33,136 +18,92 @@ class PageProxy(object):
     A page is true in a boolean context if it exists on the wiki.
     (Note that the usage in a bool context may also block.)
     """
-    def __init__(self, cache, title):
-        self.title = title
-        self.cache = cache
-        self._result = AsyncResult()
-        self.edits = {}
-
-    def _set_result(self, contents, page_info):
-        self._contents = contents
-        self.page_info = page_info
-        self._result.set()
-
-    @property
-    def contents(self):
-        """Return true if the page exists on the wiki"""
+    def _wait(self):
         self._result.get()
-        return self._contents
 
-    @property
-    def exists(self):
-        """Return true if the page exists on the wiki"""
-        return self.contents is not None
+    def edit(self, text, section=None):
+        self._queue_edit(text, section).go()
 
-    @property
-    def text(self):
-        """Return the contents of the page; raise ValueError if page missing"""
-        self._result.get()
-        if self.exists:
-            return self.contents
-        else:
-            raise ValueError('Page does not exist')
 
-    def __bool__(self):
-        return self.exists
-    __nonzero__ = __bool__
+class WikiCache(BaseWikiCache):
+    """A gevent-based cache of a MediaWiki
 
-    def edit(self, text, section=None):
-        self._result.get()
-        if not self.page_info['edittoken']:
-            raise ValueError('This Page is not editable')
-        else:
-            self.edits[section] = text
-            EditRequest(self.cache, self).go()
+    See :class:`gwikibot.cachebase.BaseWikiCache` for the other parameters.
 
+    :param force_sync: If true, the first sync with the server is done even
+        if the last one was less than five minutes ago.
 
-class WikiCache(object):
-    """A cache of a MediaWiki
+    ``cache[page_title]`` gives a PageProxy object, whose attributes block
+    until the page is loaded.
 
-    :param url_base: Base URL of the MediaWiki API,
-        e.g. 'http://en.wikipedia.org/w/api.php'
-    :param db_path: Path to a SQLite file holding the cache, or SQLAlchemy
-        database URL. If not given, a file next to the wikicache module will be
-        used.
-    :param limit: The cache will not make more than one request each `limit`
-        seconds.
-
-    Use the cache as a dictionary: ``cache[page_title]`` will give you a
-    PageProxy object.
+    HTTP requests are made with the blocking `requests` library; call
+    :func:`gwikibot.monkey.patch` first to let them run concurrently.
     """
+    page_proxy_class = PageProxy
+
     def __init__(
             self, url_base, db_url=None, force_sync=False, limit=5,
-            verbose=False):
+            verbose=False, read_stale_ok=False):
+        super(WikiCache, self).__init__(
+            url_base, db_url=db_url, limit=limit, verbose=verbose,
+            read_stale_ok=read_stale_ok)
 
-        self.verbose = verbose
+        self.request_queue = Queue(0)
 
-        if db_url is None:
-            db_url = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-                'wikicache.sqlite')
-        self.db_url = db_url
+        self._updated = Event()
+        self._force_sync = force_sync
+        self._loop = None
+        self._loop_error = None
 
-        if '://' not in db_url:
-            db_url = os.path.abspath(db_url)
-            db_url = 'sqlite:///' + db_url
+    def _new_result(self):
+        return AsyncResult()
 
-        self._engine = create_engine(db_url)
-        self._make_session = sessionmaker(bind=self._engine)
+    def _set_result(self, result, value):
+        result.set(value)
 
-        self._url_base = url_base
-        self.limit = limit
-        self.request_queue = Queue(0)
+    def _set_exception(self, result, exc):
+        result.set_exception(exc)
 
-        self._updated = Event()
+    def _go(self, request):
+        self.request(request)
+        return request.result.get()
 
-        self._loop = gevent.spawn(self._request_loop, force_sync)
+    def _drive(self, steps):
+        value = None
+        while True:
+            try:
+                call = steps.send(value)
+            except StopIteration:
+                return
+            value = self._perform(call)
+
+    def _perform(self, call):
+        """Perform an APICall or Request yielded by a step generator"""
+        if isinstance(call, Request):
+            return call.go()
+        elif call.raw:
+            return self._apirequest_raw(**call.params).raw
+        else:
+            return self.apirequest(**call.params)
 
     def request(self, req):
-        if self._loop.ready():
-            self.log('Restarting request loop')
-            self._loop = gevent.spawn(self._request_loop)
-            self._updated.wait()
+        if self._loop is None or self._loop.ready():
+            if self._loop is None:
+                force_sync = self._force_sync
+            else:
+                self.log('Restarting request loop')
+                force_sync = False
+            self._loop_error = None
+            self._updated.clear()
+            self._loop = gevent.spawn(self._request_loop, force_sync)
+            if not self.read_stale_ok:
+                self._updated.wait()
+                if self._loop_error is not None:
+                    raise self._loop_error
         if req:
+            self._pending.add(req)
             self.request_queue.put(req)
 
-    def get_wiki(self):
-        """Get the wiki object, creating one if necessary"""
-        session = self._make_session()
-        query = session.query(cacheschema.Wiki).filter_by(
-            url_base=self._url_base)
-        try:
-            wiki = query.one()
-        except (sqlalchemy.exc.OperationalError,
-                sqlalchemy.orm.exc.NoResultFound):
-            cacheschema.metadata.create_all(self._engine)
-            wiki = cacheschema.Wiki()
-            wiki.url_base = self._url_base
-            wiki.sync_timestamp = None
-            session.add(wiki)
-            session.commit()
-        wiki.session = session
-        return wiki
-
-    def log(self, string):
-        """Log a message"""
-        # TODO: Something more fancy
-        if self.verbose:
-            print string
-
-    def _sleep_seconds(self):
-        """Number of seconds to sleep until next request"""
-        now = lambda: datetime.datetime.today()
-        try:
-            next_time = self._next_request_time
-        except AttributeError:
-            return 0
-        else:
-            sleep_seconds = (next_time - now()).total_seconds()
-            if sleep_seconds > 0:
-                return sleep_seconds
-            else:
-                return 0
-
     def _sleep_before_request(self):
         """Sleep before another request can be made
 
@@ -184,8 +125,7 @@ class WikiCache(object):
             result.raise_for_status()
             return result
         finally:
-            self._next_request_time = (datetime.datetime.today() +
-                    datetime.timedelta(seconds=self.limit))
+            self._request_done()
 
     def apirequest(self, **params):
         """MW API request; returns result dict"""
@@ -194,78 +134,25 @@ class WikiCache(object):
 
     def update(self, force_sync=False):
         """Fetch a batch of page changes from the server"""
-        wiki = self.get_wiki()
-        if wiki.last_update and not force_sync:
-            thresh = datetime.datetime.today() - datetime.timedelta(minutes=5)
-            if wiki.last_update > thresh:
-                self.log('Skipping update (last update was {})'.format(
-                    wiki.last_update))
-                return
-        if wiki.sync_timestamp is None:
-            self.log('Initial cache setup')
-            feed = self.apirequest(action='query', list='recentchanges',
-                    rcprop='timestamp', rclimit=1)
-            last_change = feed['query']['recentchanges'][0]
-            wiki.sync_timestamp = last_change['timestamp']
-            wiki.synced = True
-            self.invalidate_cache(wiki)
-            wiki.session.commit()
-        else:
-            self.log('Updating cache')
-            feed = self.apirequest(action='query', list='recentchanges',
-                    rcprop='title|user|timestamp', rclimit=100,
-                    rcend=wiki.sync_timestamp
-                )
-            sync_timestamp = feed['query']['recentchanges'][0]['timestamp']
-            while feed:
-                invalidated = set()
-                changes = feed['query']['recentchanges']
-                for change in changes:
-                    title = change['title']
-                    if title not in invalidated:
-                        self.log(u'Change to {0} by {1}'.format(title,
-                                change['user']))
-                        obj = self._page_object(wiki, title)
-                        obj.last_revision = None
-                        invalidated.add(title)
-                wiki.session.commit()
-                try:
-                    feed = self.apirequest(action='query', list='recentchanges',
-                            rcprop='title|user|timestamp', rclimit=100,
-                            rcend=wiki.sync_timestamp,
-                            **feed['query-continue']['recentchanges']
-                        )
-                except KeyError:
-                    feed = None
-                    wiki.sync_timestamp = sync_timestamp
-                    wiki.synced = True
-                else:
-                    wiki.synced = False
-                wiki.session.commit()
-        wiki.last_update = datetime.datetime.today()
-        wiki.session.commit()
-
-    def _page_query(self, wiki):
-        """Return a SQLA query for pages on this wiki"""
-        return wiki.session.query(cacheschema.Page).filter_by(wiki=wiki)
-
-    def _page_object(self, wiki, title):
-        """Get an object for the page 'title', *w/o* adding it to the session
-        """
-        title = self.normalize_title(title)
-        obj = wiki.session.query(cacheschema.Page).get((self._url_base, title))
-        if obj:
-            return obj
-        else:
-            obj = cacheschema.Page()
-            obj.wiki = wiki
-            obj.title = title
-            obj.revision = None
-            obj.last_revision = None
-            return obj
+        self._drive(self._update_steps(force_sync=force_sync))
 
     def _request_loop(self, force_sync=False):
         """The greenlet that requests needed metadata/pages
+
+        If it fails, the error is passed on to all waiting requests.
+        """
+        try:
+            self._process_requests(force_sync)
+        except Exception as e:
+            self.log('Request loop failed: {!r}'.format(e))
+            while not self.request_queue.empty():
+                self.request_queue.get()
+            self._loop_error = e
+            self._fail_pending(e)
+            self._updated.set()
+
+    def _process_requests(self, force_sync):
+        """Sync the cache, then batch and run requests until there are none
         """
         self.update(force_sync=force_sync)
         self._updated.set()
@@ -277,7 +164,9 @@ class WikiCache(object):
 
             while True:
                 while not self.request_queue.empty():
-                    self.request_queue.get().insert_into(requests)
+                    request = self.request_queue.get()
+                    if request.insert_into(requests):
+                        request.run(requests)
                     gevent.sleep(0)
                 try:
                     request = self.request_queue.get(
@@ -285,7 +174,8 @@ class WikiCache(object):
                 except Empty:
                     break
                 else:
-                    request.insert_into(requests)
+                    if request.insert_into(requests):
+                        request.run(requests)
 
             request_list = [(k, v) for k, v in requests.items() if v]
             request_list.sort(key=lambda k_v: -len(k_v[1]))
@@ -302,321 +192,18 @@ class WikiCache(object):
                     self.log('Request loop exiting')
                     return
 
-
-    def invalidate_cache(self, wiki):
-        """Invalidate the entire cache
-
-        This marks all articles for re-downloading when requested.
-        Note that articles with a current revision ID will not be re-downloaded
-        entirely, only their metadata will be queried.
-        (To clear the cache entirely, truncate the articles table.)
-        """
-        self._page_query(wiki).update({'last_revision': None})
-        wiki.session.commit()
-
-
-    def normalize_title(self, title):
-        # TODO: http://www.mediawiki.org/wiki/API:Query#Title_normalization
-        title = title.replace('_', ' ')
-        title = title.replace('\n', '')
-        return title[0].upper() + title[1:]
-
-
-    def get(self, title, follow_redirect=False):
-        """Return a page from this cache
-
-        :param follow_redirect: If True, a Mediawiki redirect will be followed
-            once.
-        """
-        title = self.normalize_title(title)
-
-        if follow_redirect:
-            try:
-                return self[self.redirect_target(title)]
-            except KeyError:
-                pass
-
-        if not title:
-            return default
-
-        result = PageProxy(self, title)
-
-        gevent.spawn(self._read, result)
-        return result
+    def _start_read(self, result, token_requests):
+        gevent.spawn(self._read, result, token_requests)
 
     def _read(self, result, token_requests=()):
         """Greenlet to fill a PageProxy object
 
         Submits work to the queues until a page is fully fetched from the
-        server, then sets the PageProxy result to unblock the consumer
-        """
-        self.request(None)
-        wiki = self.get_wiki()
-        title = result.title
-        obj = self._page_object(wiki, title)
-        wiki.session.add(obj)
-        wiki.session.commit()
-        # Make sure we know the page's last revision
-        # This is a loop with rollbacks in it, since the DB can change under us
-        while True:
-            # Fetch metadata to see if the page has changed (or is empty!)
-            if obj.last_revision is None or (not obj.up_to_date and
-                    obj.contents is None) or token_requests:
-                self.log('Requesting metadata for {}'.format(title))
-                page_info = MetadataRequest(self, title, token_requests).go()
-            else:
-                page_info = {}
-            # Now, if metadata says we're out of date, actually fetch the page
-            wiki.session.refresh(obj)
-            if not obj.up_to_date:
-                self.log('Requesting page {}'.format(title))
-                PageRequest(self, title).go()
-            # If everything was successful, notify the caller!
-            wiki.session.refresh(obj)
-            if obj.up_to_date:
-                result._set_result(obj.contents, page_info)
-                wiki.session.rollback()
-                return
-
-    def __getitem__(self, title):
-        """Return the content of a page, if it exists, or raise KeyError
+        server, then sets the PageProxy result to unblock the consumer.
+        If that fails, the error is passed on to the consumer.
         """
-        return self.get(title)
-
-    def get_editable(self, title):
-        title = self.normalize_title(title)
-        result = PageProxy(self, title)
-        gevent.spawn(self._read, result, ['edit'])
-        return result
-
-
-class Request(object):
-    """A request to the remote server
-
-    Requests can be grouped together by a "group key". All requests with
-    the same group key can be gotten with the same API request.
-
-    The cache's request-loop will take requests, and as soon as there's enough
-    of them for an an API request, it does that request.
-    If there's not enough requests for a while, it fires an "incomplete"
-    request.
-    """
-    limit = 50
-
-    def __init__(self, cache):
-        self.cache = cache
-        self.result = AsyncResult()
-        self._subordinates = []
-
-    def go(self):
-        """Schedule the request and block until it's done"""
-        self.cache.request(self)
-        return self.result.get()
-
-    def insert_into(self, all_requests):
-        """Insert this request into the given dict
-
-        Run this from the request-loop greenlet; it can do the actual
-        API request if enough requests have accumulated.
-        How many are needed is specified in the "limit" variable.
-        """
-        peers = all_requests.setdefault(self.group_key, {})
         try:
-            master = peers[self.key]
-        except KeyError:
-            peers[self.key] = self
-        else:
-            master._subordinates.append(self)
-        if len(peers) >= self.limit:
-            self.run(all_requests)
-
-    @property
-    def group_key(self):
-        return (self, )
-
-    @property
-    def key(self):
-        return self
-
-    def run(self, all_requests):
-        pass
-
-    def _all_finished_requests(self, all_requests, key):
-        master = all_requests.get(self.group_key, {}).pop(key, None)
-        if master:
-            yield master
-            for s in master._subordinates:
-                yield s
-
-
-def powerset(iterable):
-    "powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"
-    s = list(iterable)
-    return itertools.chain.from_iterable(
-        itertools.combinations(s, r) for r in range(len(s)+1))
-
-
-class MetadataRequest(Request):
-    limit = 100
-
-    def __init__(self, cache, title, token_requests):
-        super(MetadataRequest, self).__init__(cache)
-        self.title = title
-        self.token_requests = tuple(sorted(token_requests))
-        self.result = AsyncResult()
-
-    @property
-    def group_key(self):
-        return MetadataRequest, self.token_requests
-
-    @property
-    def key(self):
-        return self.title
-
-    def _all_finished_requests(self, all_requests, key):
-        # A bit more complicated since we can mark all requests with a subset
-        # of our tokens as done
-        mdr, token_requests = self.group_key
-        for subset in powerset(token_requests):
-            peers = all_requests.get((MetadataRequest, subset), {})
-            master = peers.pop(key, None)
-            if master:
-                yield master
-                for s in master._subordinates:
-                    yield s
-
-    def run(self, all_requests):
-        wiki = self.cache.get_wiki()
-        titles = all_requests[self.group_key].keys()
-        # TODO: Fill up request if we can fetch more
-        kwargs = dict(
-                action='query', info='lastrevid',
-                prop='revisions',  # should not be necessary on modern MW
-                titles='|'.join(titles)
-            )
-        if self.token_requests:
-            kwargs['prop'] += '|info'
-            kwargs['intoken'] = '|'.join(self.token_requests)
-        result = self.cache.apirequest(**kwargs)
-        assert 'normalized' not in result['query'], (
-                result['query']['normalized'])  # XXX: normalization
-        fetched_titles = []
-        for page_info in result['query'].get('pages', []):
-            title = page_info['title']
-            page = self.cache._page_object(wiki, title)
-            wiki.session.add(page)
-            if 'missing' in page_info:
-                page.last_revision = 0
-                page.revision = 0
-                page.contents = None
-            else:
-                revid = page_info['revisions'][0]['revid']
-                # revid = page_info['lastrevid']  # for the modern MW
-                page.last_revision = revid
-            for p in self._all_finished_requests(all_requests, title):
-                p.result.set(page_info)
-        wiki.session.commit()
-
-
-class PageRequest(Request):
-    def __init__(self, cache, title):
-        super(PageRequest, self).__init__(cache)
-        self.title = title
-
-    @property
-    def group_key(self):
-        return (PageRequest,)
-
-    @property
-    def key(self):
-        return self.title
-
-    def run(self, all_requests):
-        wiki = self.cache.get_wiki()
-        titles = all_requests[self.group_key].keys()
-
-        dump = self.cache._apirequest_raw(action='query',
-            export='1', exportnowrap='1',
-            titles='|'.join(titles)).raw
-        tree = ElementTree.parse(dump)
-        for elem in tree.getroot():
-            tag = elem.tag
-            if tag.endswith('}siteinfo'):
-                continue
-            elif tag.endswith('}page'):
-                revision, = (e for e in elem if e.tag.endswith('}revision'))
-                pagename, = (e for e in elem if e.tag.endswith('}title'))
-                text, = (e for e in revision if e.tag.endswith('}text'))
-                revid, = (e for e in revision if e.tag.endswith('}id'))
-                title = pagename.text
-                page = self.cache._page_object(wiki, title)
-                page.last_revision = int(revid.text)
-                page.revision = int(revid.text)
-                page.contents = text.text
-                wiki.session.add(page)
-                for p in self._all_finished_requests(all_requests, title):
-                    p.result.set()
-            else:
-                raise ValueError(tag)
-        wiki.session.commit()
-
-
-class SingleRequest(Request):
-    """A request that can't be combined with others
-
-    A SingleRequest is run as soon as it's picked up from the request queue.
-    """
-    limit = 1
-
-    def insert_into(self, all_requests):
-        self.run(all_requests)
-
-
-class EditRequest(SingleRequest):
-    def __init__(self, cache, pageproxy):
-        super(EditRequest, self).__init__(cache)
-        self.pageproxy = pageproxy
-        self.title = pageproxy.title
-        self.edittoken = pageproxy.page_info['edittoken']
-        self.starttimestamp = pageproxy.page_info['starttimestamp']
-
-    def run(self, all_requests):
-        pageproxy = self.pageproxy
-        edits = pageproxy.edits
-        if not edits:
-            return
-
-        revid = None
-
-        wiki = self.cache.get_wiki()
-        page = self.cache._page_object(wiki, self.title)
-        page.last_revision = None
-        wiki.session.commit()
-
-        whole_page_edit = edits.pop(None)
-        if (whole_page_edit is not None and
-                (pageproxy.contents is None or
-                    whole_page_edit != pageproxy.contents)):
-            self.do_edit(None, whole_page_edit)
-        for section, text in edits.items():
-            self.do_edit(section, text)
-
-        self.result.set()
-
-    def do_edit(self, section, text):
-        kwargs = dict(
-            action='edit',
-            title=self.title,
-            text=text,
-            token=self.edittoken,
-            summary='gwikibot edit',  # TODO
-            minor=False,  # TODO
-            bot=True,  # TODO
-            starttimestamp=self.starttimestamp,
-            # TODO: recreate, createonly, nocreate
-        )
-        if section is not None:
-            kwargs['section'] = section
-        result = self.cache.apirequest(**kwargs)
-        revid = result['edit']['newrevid']
-        self.starttimestamp = result['edit']['newtimestamp']
+            self.request(None)
+            self._drive(self._read_steps(result, token_requests))
+        except Exception as e:
+            self._set_exception(result._result, e)
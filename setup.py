@@ -6,10 +6,12 @@ args = dict(
     packages = find_packages(),
     install_requires=[
         'sqlalchemy',
-        'gevent',
         'pyyaml',
-        'requests',
     ],
+    extras_require={
+        'gevent': ['gevent', 'requests'],
+        'asyncio': ['aiohttp'],
+    },
 )
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import pytest
+
+
+class FakeWiki(object):
+    """A simulated MediaWiki server
+
+    The cache tests replace the caches' HTTP requests by calls to `api`
+    (for YAML results) and `export` (for the XML dump).
+    Calls that were answered are recorded in `calls`; if `error` is set,
+    it is raised instead.
+    """
+    def __init__(self):
+        self.pages = {'A': 'Text of A', 'B': 'Text of B'}
+        self.revisions = {'A': 1, 'B': 2}
+        self.changed = ['A']
+        self.calls = []
+        self.error = None
+        self.latency = 0
+
+    def change(self, title, text):
+        """Edit a page on the server, and list it in recent changes"""
+        self.pages[title] = text
+        self.revisions[title] = max(self.revisions.values()) + 1
+        self.changed = [title]
+
+    def calls_of(self, kind):
+        """Return answered calls of the given kind
+
+        Kinds are 'recentchanges', 'metadata', 'export' and 'edit'.
+        """
+        return [c for c in self.calls if self._kind(c) == kind]
+
+    def edits(self):
+        """Return (section, text) of answered edit calls"""
+        return [(c.get('section'), c['text']) for c in self.calls_of('edit')]
+
+    def _kind(self, params):
+        if params['action'] == 'edit':
+            return 'edit'
+        elif params.get('list') == 'recentchanges':
+            return 'recentchanges'
+        elif params.get('export'):
+            return 'export'
+        else:
+            return 'metadata'
+
+    def _answer(self, params):
+        if self.error is not None:
+            raise self.error
+        self.calls.append(params)
+
+    def api(self, params):
+        self._answer(params)
+        kind = self._kind(params)
+        if kind == 'recentchanges':
+            return {'query': {'recentchanges': [
+                {'timestamp': '2000-01-01T00:00:00Z', 'title': title,
+                 'user': 'Someone'}
+                for title in self.changed]}}
+        elif kind == 'edit':
+            title = params['title']
+            self.revisions[title] = max(self.revisions.values()) + 1
+            if 'section' not in params:
+                self.pages[title] = params['text']
+            return {'edit': {'newrevid': self.revisions[title],
+                             'newtimestamp': '2000-01-02T00:00:00Z'}}
+        else:
+            pages = []
+            for title in params['titles'].split('|'):
+                if title in self.pages:
+                    info = dict(title=title,
+                        revisions=[dict(revid=self.revisions[title])])
+                else:
+                    info = dict(title=title, missing='')
+                if 'edit' in params.get('intoken', ''):
+                    info['edittoken'] = '+\\'
+                    info['starttimestamp'] = '2000-01-01T00:00:00Z'
+                pages.append(info)
+            return {'query': {'pages': pages}}
+
+    def export(self, params):
+        self._answer(params)
+        pages = ''.join(
+            '<page><title>{}</title><revision><id>{}</id>'
+            '<text>{}</text></revision></page>'.format(
+                title, self.revisions[title], self.pages[title])
+            for title in params['titles'].split('|'))
+        return '<mediawiki xmlns="x">{}</mediawiki>'.format(pages).encode()
+
+
+@pytest.fixture
+def fake_wiki():
+    return FakeWiki()
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    return str(tmp_path / 'wikicache.sqlite')
@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+
+import pytest
+
+from gwikibot.aiowikicache import AsyncWikiCache
+
+
+class StubAsyncWikiCache(AsyncWikiCache):
+    """AsyncWikiCache that talks to a FakeWiki instead of over HTTP"""
+    def __init__(self, fake, db_url, **kwargs):
+        self.fake = fake
+        super(StubAsyncWikiCache, self).__init__(
+            'http://wiki.invalid/api.php', db_url=db_url, limit=0, **kwargs)
+
+    async def apirequest(self, **params):
+        await asyncio.sleep(self.fake.latency)
+        return self.fake.api(params)
+
+    async def _apirequest_raw(self, **params):
+        await asyncio.sleep(self.fake.latency)
+        return self.fake.export(params)
+
+
+@pytest.fixture
+def run_with_cache(fake_wiki, db_url):
+    """Run an async function with a new cache as its argument"""
+    def run_with_cache(func, **kwargs):
+        async def main():
+            async with StubAsyncWikiCache(fake_wiki, db_url, **kwargs) as c:
+                await func(c)
+        asyncio.run(main())
+    return run_with_cache
+
+
+def test_batched_read(run_with_cache, fake_wiki):
+    async def check(cache):
+        pages = await asyncio.gather(
+            *[cache[title] for title in ['A', 'B', 'Missing']])
+        assert [page.contents for page in pages] == [
+            'Text of A', 'Text of B', None]
+        assert [bool(page) for page in pages] == [True, True, False]
+    run_with_cache(check)
+    metadata_call, = fake_wiki.calls_of('metadata')
+    assert sorted(metadata_call['titles'].split('|')) == ['A', 'B', 'Missing']
+    export_call, = fake_wiki.calls_of('export')
+    assert sorted(export_call['titles'].split('|')) == ['A', 'B']
+
+
+def test_unloaded_page(run_with_cache):
+    async def check(cache):
+        page = cache['A']
+        with pytest.raises(RuntimeError):
+            page.text
+        await page
+        assert page.text == 'Text of A'
+    run_with_cache(check)
+
+
+def test_edit(run_with_cache, fake_wiki):
+    async def check(cache):
+        page = await cache.get_editable('A')
+        assert page.text == 'Text of A'
+        await page.edit('New text')
+        edit_call, = fake_wiki.calls_of('edit')
+        assert edit_call['text'] == 'New text'
+        assert edit_call['token'] == '+\\'
+        assert 'section' not in edit_call
+        assert (await cache['A']).text == 'New text'
+    run_with_cache(check)
+
+
+def test_section_edit(run_with_cache, fake_wiki):
+    async def check(cache):
+        page = cache.get_editable('A')
+        await page.edit('Section 1', section=1)
+        await page.edit('Section 2', section=2)
+        assert fake_wiki.edits() == [(1, 'Section 1'), (2, 'Section 2')]
+    run_with_cache(check)
+
+
+def test_concurrent_edits(run_with_cache, fake_wiki):
+    async def check(cache):
+        page = await cache.get_editable('A')
+        await asyncio.wait_for(asyncio.gather(
+            page.edit('New text'), page.edit('Section 1', section=1)), 5)
+        assert fake_wiki.edits() == [(None, 'New text'), (1, 'Section 1')]
+    run_with_cache(check)
+
+
+def test_failure_reaches_caller(run_with_cache, fake_wiki):
+    async def check(cache):
+        fake_wiki.error = IOError('Server down')
+        with pytest.raises(IOError):
+            await asyncio.wait_for(cache['A'], 5)
+        fake_wiki.error = None
+        assert (await asyncio.wait_for(cache['A'], 5)).text == 'Text of A'
+    run_with_cache(check)
+
+
+def test_close_cancels_pages(fake_wiki, db_url):
+    fake_wiki.latency = 10
+
+    async def main():
+        cache = StubAsyncWikiCache(fake_wiki, db_url)
+        page = cache['A']
+        await asyncio.sleep(0.01)
+        await cache.close()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(page, 5)
+    asyncio.run(main())
+
+
+async def fill_cache(cache):
+    """Cache pages A and B and make the last sync a day old
+
+    B is marked as not known to be current, so reading it normally needs
+    an API call.
+    """
+    await asyncio.gather(cache['A'], cache['B'])
+    wiki = cache.get_wiki()
+    cache._page_object(wiki, 'B').last_revision = None
+    wiki.last_update = datetime.datetime.today() - datetime.timedelta(days=1)
+    wiki.session.commit()
+
+
+def test_first_read_waits_for_sync(run_with_cache, fake_wiki):
+    run_with_cache(fill_cache)
+    fake_wiki.change('A', 'New text of A')
+
+    async def check(cache):
+        assert (await cache['A']).text == 'New text of A'
+    run_with_cache(check)
+
+
+def test_read_stale_ok(run_with_cache, fake_wiki):
+    run_with_cache(fill_cache)
+    fake_wiki.change('A', 'New text of A')
+    fake_wiki.calls = []
+    fake_wiki.latency = 0.05
+
+    async def check(cache):
+        assert cache._sessionmaker is None
+        assert (await cache['B']).text == 'Text of B'
+        assert fake_wiki.calls == []
+        # The sync still runs, and invalidates the changed page
+        await cache._updated.wait()
+        wiki = cache.get_wiki()
+        assert cache._page_object(wiki, 'A').last_revision is None
+        page = await cache.get_editable('A')
+        assert page.text == 'New text of A'
+        assert page.page_info['edittoken'] == '+\\'
+    run_with_cache(check, read_stale_ok=True)
+
+
+def test_read_stale_ok_after_edit(run_with_cache):
+    async def check(cache):
+        await cache.get_editable('A').edit('New text')
+        assert (await cache['A']).text == 'New text'
+    run_with_cache(check, read_stale_ok=True)
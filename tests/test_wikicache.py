@@ -0,0 +1,143 @@
+import io
+import datetime
+
+import gevent
+import pytest
+
+from gwikibot.wikicache import WikiCache
+
+
+class StubWikiCache(WikiCache):
+    """WikiCache that talks to a FakeWiki instead of over HTTP"""
+    def __init__(self, fake, db_url, **kwargs):
+        self.fake = fake
+        super(StubWikiCache, self).__init__(
+            'http://wiki.invalid/api.php', db_url=db_url, limit=0, **kwargs)
+
+    def apirequest(self, **params):
+        gevent.sleep(self.fake.latency)
+        return self.fake.api(params)
+
+    def _apirequest_raw(self, **params):
+        gevent.sleep(self.fake.latency)
+        response = lambda: None
+        response.raw = io.BytesIO(self.fake.export(params))
+        return response
+
+
+@pytest.fixture
+def make_cache(fake_wiki, db_url):
+    caches = []
+
+    def make_cache(**kwargs):
+        cache = StubWikiCache(fake_wiki, db_url, **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make_cache
+
+    for cache in caches:
+        if cache._loop is not None:
+            cache._loop.kill()
+
+
+def test_batched_read(make_cache, fake_wiki):
+    cache = make_cache()
+    pages = [cache[title] for title in ['A', 'B', 'Missing']]
+    assert [page.contents for page in pages] == [
+        'Text of A', 'Text of B', None]
+    assert [bool(page) for page in pages] == [True, True, False]
+    metadata_call, = fake_wiki.calls_of('metadata')
+    assert sorted(metadata_call['titles'].split('|')) == ['A', 'B', 'Missing']
+    export_call, = fake_wiki.calls_of('export')
+    assert sorted(export_call['titles'].split('|')) == ['A', 'B']
+
+
+def test_edit(make_cache, fake_wiki):
+    cache = make_cache()
+    page = cache.get_editable('A')
+    assert page.text == 'Text of A'
+    page.edit('New text')
+    edit_call, = fake_wiki.calls_of('edit')
+    assert edit_call['text'] == 'New text'
+    assert edit_call['token'] == '+\\'
+    assert 'section' not in edit_call
+    assert cache['A'].text == 'New text'
+
+
+def test_section_edit(make_cache, fake_wiki):
+    cache = make_cache()
+    page = cache.get_editable('A')
+    page.edit('Section 1', section=1)
+    page.edit('Section 2', section=2)
+    assert fake_wiki.edits() == [(1, 'Section 1'), (2, 'Section 2')]
+
+
+def test_failure_reaches_caller(make_cache, fake_wiki):
+    cache = make_cache()
+    fake_wiki.error = IOError('Server down')
+    with pytest.raises(IOError):
+        cache['A'].text
+    fake_wiki.error = None
+    assert cache['A'].text == 'Text of A'
+
+
+def fill_cache(make_cache, fake_wiki):
+    """Cache pages A and B, then change A on the server a day later
+
+    B is marked as not known to be current, so reading it normally needs
+    an API call.
+    """
+    cache = make_cache()
+    for title in ['A', 'B']:
+        cache[title].text
+    cache._loop.kill()
+    wiki = cache.get_wiki()
+    cache._page_object(wiki, 'B').last_revision = None
+    wiki.last_update = datetime.datetime.today() - datetime.timedelta(days=1)
+    wiki.session.commit()
+    fake_wiki.change('A', 'New text of A')
+    fake_wiki.calls = []
+
+
+def test_lazy_construction(make_cache):
+    cache = make_cache()
+    assert cache._sessionmaker is None
+    assert cache._loop is None
+    assert cache['A'].text == 'Text of A'
+    assert cache._sessionmaker is not None
+
+
+def test_first_read_waits_for_sync(make_cache, fake_wiki):
+    fill_cache(make_cache, fake_wiki)
+    cache = make_cache()
+    assert cache['A'].text == 'New text of A'
+
+
+def test_read_stale_ok(make_cache, fake_wiki):
+    fill_cache(make_cache, fake_wiki)
+    fake_wiki.latency = 0.05
+    cache = make_cache(read_stale_ok=True)
+    assert cache['B'].text == 'Text of B'
+    assert fake_wiki.calls == []
+    # The sync still runs, and invalidates the changed page
+    cache._updated.wait()
+    assert fake_wiki.calls_of('recentchanges')
+    wiki = cache.get_wiki()
+    assert cache._page_object(wiki, 'A').last_revision is None
+
+
+def test_read_stale_ok_editable(make_cache, fake_wiki):
+    fill_cache(make_cache, fake_wiki)
+    cache = make_cache(read_stale_ok=True)
+    page = cache.get_editable('A')
+    assert page.text == 'New text of A'
+    assert page.page_info['edittoken'] == '+\\'
+    metadata_call, = fake_wiki.calls_of('metadata')
+    assert metadata_call['intoken'] == 'edit'
+
+
+def test_read_stale_ok_after_edit(make_cache, fake_wiki):
+    cache = make_cache(read_stale_ok=True)
+    cache.get_editable('A').edit('New text')
+    assert cache['A'].text == 'New text'